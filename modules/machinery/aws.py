@@ -0,0 +1,688 @@
+# Copyright (C) 2010-2015 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+try:
+    import boto3
+    from botocore.config import Config as BotocoreConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    sys.exit("Missed boto3 dependency: pip install boto3")
+
+try:
+    import aioboto3
+
+    HAVE_AIOBOTO3 = True
+except ImportError:
+    HAVE_AIOBOTO3 = False
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from lib.cuckoo.common.abstracts import Machinery
+from lib.cuckoo.common.config import Config
+from lib.cuckoo.common.exceptions import CuckooMachineError
+from lib.cuckoo.core.database import Machine
+
+logging.getLogger("boto3").setLevel(logging.CRITICAL)
+logging.getLogger("botocore").setLevel(logging.CRITICAL)
+
+log = logging.getLogger(__name__)
+
+cfg = Config()
+
+
+@dataclass(slots=True)
+class _EC2Handle:
+    """Lightweight stand-in for a boto3 Instance resource.
+
+    Holds only the instance id, the shared low-level client and whether the
+    machine is autoscaled, so a large fleet does not carry per-VM resource
+    model overhead. The full Instance resource is materialized on demand
+    where volume and placement data are needed (_restore).
+    """
+
+    id: str
+    client: object
+    autoscaled: bool = False
+
+    def start(self):
+        self.client.start_instances(InstanceIds=[self.id])
+
+    def stop(self, force=False):
+        self.client.stop_instances(InstanceIds=[self.id], Force=force)
+
+    def terminate(self):
+        self.client.terminate_instances(InstanceIds=[self.id])
+
+
+class _StatusBatch:
+    """A single in-flight batch of instance state lookups."""
+
+    __slots__ = ("ids", "event", "states", "fired")
+
+    def __init__(self):
+        self.ids = set()
+        self.event = threading.Event()
+        self.states = {}
+        self.fired = False
+
+
+class _StatusBatcher:
+    """Coalesce concurrent instance state lookups into one DescribeInstanceStatus.
+
+    Callers joining within the batch window share a single RPC instead of
+    issuing one describe each, so polling N machines costs one API call per
+    window rather than N. DescribeInstanceStatus is used rather than
+    DescribeInstances: its responses carry just the state instead of the full
+    instance blob (tags, block devices, network interfaces), and it draws
+    from a separate API throttle bucket.
+    """
+
+    # How long a batch stays open for more callers to join.
+    MAX_DELAY = 0.25
+    # DescribeInstanceStatus accepts at most 100 explicit instance ids.
+    MAX_BATCH_SIZE = 100
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def get(self, instance_id):
+        """Get the EC2 state name of an instance.
+        @param instance_id: the instance id.
+        @return: the state name, or None if AWS did not return the instance.
+        """
+        with self._lock:
+            batch = self._batch
+            if batch is None:
+                batch = self._batch = _StatusBatch()
+                timer = threading.Timer(self.MAX_DELAY, self._fire, (batch,))
+                timer.daemon = True
+                timer.start()
+            batch.ids.add(instance_id)
+            fire_now = len(batch.ids) >= self.MAX_BATCH_SIZE
+            if fire_now:
+                # Detach the full batch while still holding the lock, so late
+                # joiners start a fresh one instead of pushing this batch past
+                # the API's per-call id limit before _fire snapshots it.
+                self._batch = None
+        if fire_now:
+            self._fire(batch)
+        batch.event.wait()
+        return batch.states.get(instance_id)
+
+    def _fire(self, batch):
+        with self._lock:
+            if batch.fired:
+                return
+            batch.fired = True
+            if self._batch is batch:
+                self._batch = None
+        try:
+            # IncludeAllInstances also returns instances that are not
+            # running, which the stopped/stopping checks rely on.
+            response = self._client.describe_instance_status(InstanceIds=list(batch.ids), IncludeAllInstances=True)
+            for instance_status in response["InstanceStatuses"]:
+                batch.states[instance_status["InstanceId"]] = instance_status["InstanceState"]["Name"]
+        except Exception as e:
+            log.exception("Batched DescribeInstanceStatus failed: %s", e)
+        finally:
+            batch.event.set()
+
+
+class AWS(Machinery):
+    """Virtualization layer for AWS."""
+
+    module_name = "aws"
+
+    # VM states.
+    PENDING = "pending"
+    STOPPING = "stopping"
+    RUNNING = "running"
+    POWEROFF = "poweroff"
+    ERROR = "machete"
+
+    AUTOSCALE_CUCKOO = "AUTOSCALE_CUCKOO"
+
+    # Waiter tuning for EBS volume state transitions during restore.
+    WAITER_CONFIG = {"Delay": 2, "MaxAttempts": 60}
+
+    # How long a _status result stays valid. Small enough that _wait_status
+    # loops still observe transitions, large enough to coalesce the adjacent
+    # reads that stop()/_restore() perform on the same label.
+    STATUS_CACHE_TTL = 0.5
+
+    def _initialize_check(self):
+        """Run all checks when a machine manager is initialized.
+        @raise CuckooMachineError: if a configured machine is not available on AWS.
+        """
+        self.ec2_machines = {}
+        self.dynamic_machines_sequence = 0
+        self.dynamic_machines_count = 0
+        self._cached_resultserver_port = None
+        self._status_cache = {}
+        # Per-machine option names created for dynamic machines, keyed by
+        # label, so they can be dropped again when the machine is terminated.
+        self._dynamic_machine_opts = {}
+        # Snapshot the config sections once; the hot allocation paths read
+        # them on every call and the sections do not change at runtime.
+        self._aws_opts = self.options.get("aws")
+        self._autoscale_opts = self.options.get("autoscale")
+
+        machinery_options = self._aws_opts
+        log.info("Connecting to AWS in region %s", machinery_options["region_name"])
+        self.ec2_resource = boto3.resource(
+            "ec2",
+            region_name=machinery_options["region_name"],
+            aws_access_key_id=machinery_options["aws_access_key_id"],
+            aws_secret_access_key=machinery_options["aws_secret_access_key"],
+            # Adaptive retries give us client-side rate limiting with
+            # exponential backoff when EC2 answers with RequestLimitExceeded
+            # during scaling bursts; the larger connection pool lets the
+            # thread-pooled batch calls actually run in parallel.
+            config=BotocoreConfig(retries={"mode": "adaptive", "max_attempts": 10}, max_pool_connections=32),
+        )
+        self._status_batcher = _StatusBatcher(self.ec2_resource.meta.client)
+
+        self._aio_loop = None
+        self._aio_loop_lock = threading.Lock()
+        if HAVE_AIOBOTO3:
+            self._aio_session = aioboto3.Session(
+                region_name=machinery_options["region_name"],
+                aws_access_key_id=machinery_options["aws_access_key_id"],
+                aws_secret_access_key=machinery_options["aws_secret_access_key"],
+            )
+
+        # Clean up autoscaled instances left over from a previous run. The tag
+        # match is pushed down into the EC2 filter so only our instances come
+        # back, instead of paging the whole account and scanning tags here.
+        ids_to_terminate = [
+            instance.id
+            for instance in self.ec2_resource.instances.filter(
+                Filters=[
+                    {"Name": "instance-state-name", "Values": ["pending", "running", "stopping"]},
+                    {"Name": "tag-key", "Values": [self.AUTOSCALE_CUCKOO]},
+                ]
+            )
+        ]
+        if ids_to_terminate:
+            log.info("Terminating %d autoscaled instance(s): %s", len(ids_to_terminate), ", ".join(ids_to_terminate))
+            client = self.ec2_resource.meta.client
+            # TerminateInstances accepts up to 1000 instance ids per call.
+            for i in range(0, len(ids_to_terminate), 1000):
+                client.terminate_instances(InstanceIds=ids_to_terminate[i : i + 1000])
+
+        # Describe only the configured instance ids rather than paging every
+        # instance on the account; the payload no longer scales with account
+        # size.
+        instance_ids = self._describe_configured_instances([machine.label for machine in self.machines()])
+        for machine in self.machines():
+            if machine.label not in instance_ids:
+                raise CuckooMachineError(f"Configured machine {machine.label} was not detected on your AWS account")
+            self.ec2_machines[machine.label] = _EC2Handle(machine.label, self.ec2_resource.meta.client)
+
+        self._start_or_create_machines()
+
+    def _start_or_create_machines(self):
+        """Start preconfigured machines and, when autoscale is enabled, create
+        new ones until the pool of ready machines reaches running_machines_gap.
+        """
+        machinery_options = self._aws_opts
+        autoscale_options = self._autoscale_opts
+
+        current_available_machines = self.db.count_machines_available()
+        running_machines_gap = machinery_options.get("running_machines_gap", 0)
+        dynamic_machines_limit = autoscale_options["dynamic_machines_limit"]
+
+        self._start_next_machines(num_of_machines_to_start=min(current_available_machines, running_machines_gap))
+
+        if not autoscale_options["autoscale"]:
+            return
+
+        # If the pool is still too small, scale up with dynamic machines,
+        # launched through a single RunInstances call.
+        machines_to_create = running_machines_gap - current_available_machines
+        if machines_to_create <= 0:
+            return
+        allowed = dynamic_machines_limit - self.dynamic_machines_count
+        if allowed <= 0:
+            log.debug("Reached dynamic machines limit - %d machines", dynamic_machines_limit)
+            return
+        self._allocate_new_machines(min(machines_to_create, allowed))
+
+    def _start_next_machines(self, num_of_machines_to_start):
+        """Start the next machines in the available machines queue, so they are
+        up and ready before a task is actually assigned to them.
+        @param num_of_machines_to_start: how many machines to start.
+        """
+        candidates = [machine.label for machine in self.db.get_available_machines()]
+        if num_of_machines_to_start <= 0 or not candidates:
+            return
+
+        # Query the candidate states concurrently so the lookups coalesce
+        # into batched describe calls instead of one RPC per machine.
+        with ThreadPoolExecutor(max_workers=min(len(candidates), 32)) as executor:
+            statuses = dict(zip(candidates, executor.map(self._status, candidates)))
+
+        to_start = []
+        for label in candidates:
+            if len(to_start) >= num_of_machines_to_start:
+                break
+            if statuses[label] in (AWS.POWEROFF, AWS.STOPPING):
+                to_start.append(label)
+
+        if to_start:
+            # StartInstances accepts up to 1000 ids, so the whole batch goes
+            # out in one call.
+            self.ec2_resource.meta.client.start_instances(InstanceIds=to_start)
+            for label in to_start:
+                self._invalidate_status(label)
+
+    def _allocate_new_machines(self, count):
+        """Allocate new machines for the pool of dynamic machines in a single
+        RunInstances call.
+        @param count: how many machines to launch.
+        @return: how many machines were actually allocated.
+        """
+        machinery_options = self._aws_opts
+        autoscale_options = self._autoscale_opts
+        # If configured, use a specific network interface for these machines,
+        # else use the default value.
+        interface = autoscale_options["interface"] if autoscale_options.get("interface") else machinery_options.get("interface")
+        resultserver_ip = autoscale_options["resultserver_ip"] if autoscale_options.get("resultserver_ip") else cfg.resultserver.ip
+        resultserver_port = self._get_resultserver_port(autoscale_options)
+
+        new_instances = self._create_instances(count, tags=[{"Key": self.AUTOSCALE_CUCKOO, "Value": "True"}])
+        for new_instance in new_instances:
+            self.dynamic_machines_sequence += 1
+            self.dynamic_machines_count += 1
+            new_machine_name = f"vmanyscale{self.dynamic_machines_sequence}"
+            new_instance.create_tags(Tags=[{"Key": "Name", "Value": new_machine_name}])
+            log.info("Allocating a new machine %s (%s) to meet pool size requirements", new_machine_name, new_instance.id)
+            self.ec2_machines[new_instance.id] = _EC2Handle(new_instance.id, self.ec2_resource.meta.client, autoscaled=True)
+            # Set a "new_machine" option in the configuration object, so the
+            # machine lookup of the base class does not raise an exception.
+            # Remember the name so stop() can remove the attribute again;
+            # otherwise the Config object grows for as long as the process
+            # lives while machines churn.
+            setattr(self.options, new_machine_name, {})
+            self._dynamic_machine_opts[new_instance.id] = new_machine_name
+
+            self.db.add_machine(
+                name=new_machine_name,
+                label=new_instance.id,
+                arch=autoscale_options.get("arch", "x64"),
+                ip=new_instance.private_ip_address,
+                platform=autoscale_options["platform"],
+                tags=autoscale_options["tags"],
+                interface=interface,
+                snapshot=autoscale_options.get("guest_snapshot"),
+                resultserver_ip=resultserver_ip,
+                resultserver_port=resultserver_port,
+            )
+        return len(new_instances)
+
+    def _get_resultserver_port(self, autoscale_options):
+        """Get the result server port for a new dynamic machine.
+        @param autoscale_options: the autoscale configuration section.
+        @return: the configured port, or the running ResultServer's port.
+        """
+        if autoscale_options.get("resultserver_port"):
+            return autoscale_options["resultserver_port"]
+
+        if self._cached_resultserver_port is None:
+            # The ResultServer port might have been dynamically changed, so
+            # get it from the ResultServer singleton. Also avoid import
+            # recursion issues by importing ResultServer here. The port does
+            # not change afterwards, so cache it across allocations.
+            from lib.cuckoo.core.resultserver import ResultServer
+
+            self._cached_resultserver_port = ResultServer().port
+        return self._cached_resultserver_port
+
+    def _create_instances(self, count, tags):
+        """Create new EC2 instances through a single RunInstances call.
+        @param count: how many instances to request; AWS may launch fewer.
+        @param tags: tags to attach to the new instances.
+        @return: list of created instances, empty on failure.
+        """
+        autoscale_options = self._autoscale_opts
+        try:
+            response = self.ec2_resource.create_instances(
+                BlockDeviceMappings=[
+                    {
+                        "DeviceName": "/dev/sda1",
+                        "Ebs": {"DeleteOnTermination": True, "VolumeType": "gp2"},
+                    }
+                ],
+                ImageId=autoscale_options["image_id"],
+                InstanceType=autoscale_options["instance_type"],
+                MaxCount=count,
+                MinCount=1,
+                NetworkInterfaces=[
+                    {
+                        "DeviceIndex": 0,
+                        "SubnetId": autoscale_options["subnet_id"],
+                        "Groups": autoscale_options["security_groups"].split(","),
+                    }
+                ],
+                TagSpecifications=[{"ResourceType": "instance", "Tags": tags}],
+            )
+        except Exception as e:
+            log.error("Failed to create new instances: %s", e)
+            return []
+
+        # The instances route result server traffic, so source/dest checking
+        # has to be off. ModifyInstanceAttribute only takes one instance per
+        # call, so submit the calls concurrently against the shared client
+        # (boto3 clients are thread-safe and pool their connections); the
+        # batch costs roughly one round-trip instead of one per instance.
+        client = self.ec2_resource.meta.client
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(client.modify_instance_attribute, InstanceId=new_instance.id, SourceDestCheck={"Value": False})
+                for new_instance in response
+            ]
+            for future in futures:
+                future.result()
+
+        for new_instance in response:
+            log.debug("Created new instance %s", new_instance.id)
+        return response
+
+    def _delete_machine_form_db(self, label, session=None):
+        """Remove a machine from the database; Database does not implement
+        machine deletion, so we do it here.
+        @param label: machine label.
+        @param session: an existing session to reuse. The caller owns its
+            lifetime and its commit; without one, a short-lived session is
+            opened, committed and closed here.
+        """
+        owns_session = session is None
+        if owns_session:
+            session = self.db.Session()
+        try:
+            machine = session.query(Machine).filter_by(label=label).first()
+            if machine:
+                session.delete(machine)
+                if owns_session:
+                    session.commit()
+        except SQLAlchemyError as e:
+            log.debug("Database error removing machine: %s", e)
+            session.rollback()
+        finally:
+            if owns_session:
+                session.close()
+
+    def _describe_configured_instances(self, labels):
+        """Describe the given instance ids on the AWS account.
+        @param labels: the configured instance ids.
+        @return: set of instance ids that exist on the account.
+        """
+        if not labels:
+            return set()
+
+        client = self.ec2_resource.meta.client
+        try:
+            response = client.describe_instances(InstanceIds=labels)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "InvalidInstanceID.NotFound":
+                raise
+            # At least one configured id does not exist on this account; fall
+            # back to describing them one by one so the valid ones still load
+            # and the per-machine check reports exactly which are missing.
+            found = set()
+            for label in labels:
+                try:
+                    response = client.describe_instances(InstanceIds=[label])
+                except ClientError as single_e:
+                    if single_e.response.get("Error", {}).get("Code") == "InvalidInstanceID.NotFound":
+                        continue
+                    raise
+                for reservation in response["Reservations"]:
+                    found.update(instance["InstanceId"] for instance in reservation["Instances"])
+            return found
+
+        return {instance["InstanceId"] for reservation in response["Reservations"] for instance in reservation["Instances"]}
+
+    def _list(self):
+        """List the instances on the AWS account.
+        @return: list of instance ids.
+        """
+        instances = self.ec2_resource.instances.filter(
+            Filters=[{"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]}]
+        )
+        return [instance.id for instance in instances]
+
+    def _status(self, label):
+        """Get the current status of a machine.
+        @param label: machine label.
+        @return: machine status.
+        """
+        cached = self._status_cache.get(label)
+        if cached is not None and time.monotonic() - cached[1] < self.STATUS_CACHE_TTL:
+            return cached[0]
+
+        try:
+            state = self._status_batcher.get(label)
+            if state == "running":
+                status = AWS.RUNNING
+            elif state == "stopped":
+                status = AWS.POWEROFF
+            elif state == "pending":
+                status = AWS.PENDING
+            elif state == "stopping":
+                status = AWS.STOPPING
+            elif state in ("shutting-down", "terminated"):
+                status = AWS.ERROR
+            else:
+                status = AWS.ERROR
+            log.debug("Machine %s status %s", label, status)
+            self._status_cache[label] = (status, time.monotonic())
+            return status
+        except Exception as e:
+            log.exception("Can't retrieve the status of %s: %s", label, e)
+            return AWS.ERROR
+
+    def _invalidate_status(self, label):
+        """Drop the cached status of a machine after a mutating API call.
+        @param label: machine label.
+        """
+        self._status_cache.pop(label, None)
+
+    def start(self, label):
+        """Start a machine.
+        @param label: machine label.
+        @raise CuckooMachineError: if unable to start the machine.
+        """
+        log.debug("Starting vm %s", label)
+
+        if self.ec2_machines[label].autoscaled:
+            # Autoscaled machines are already running once created.
+            return
+
+        self.ec2_machines[label].start()
+        self._invalidate_status(label)
+        self._wait_status(label, AWS.RUNNING)
+
+    def stop(self, label):
+        """Stop a machine. Autoscaled machines are terminated and removed from
+        the database, preconfigured machines are stopped and restored.
+        @param label: machine label.
+        @raise CuckooMachineError: if unable to stop the machine.
+        """
+        log.debug("Stopping vm %s", label)
+
+        status = self._status(label)
+        if status == AWS.POWEROFF:
+            raise CuckooMachineError(f"Trying to stop an already stopped VM: {label}")
+
+        if self.ec2_machines[label].autoscaled:
+            self.ec2_machines[label].terminate()
+            self._invalidate_status(label)
+            self._delete_machine_form_db(label)
+            self.dynamic_machines_count -= 1
+            # The machine is gone for good; drop every piece of state we
+            # keep for it so memory stays bounded as machines churn.
+            self.ec2_machines.pop(label, None)
+            machine_name = self._dynamic_machine_opts.pop(label, None)
+            if machine_name and hasattr(self.options, machine_name):
+                delattr(self.options, machine_name)
+        else:
+            self.ec2_machines[label].stop(force=True)
+            self._invalidate_status(label)
+            self._wait_status(label, AWS.POWEROFF)
+            self._restore(label)
+
+    def release(self, label=None):
+        """Release a machine. Overridden to scale the pool back up once a
+        machine frees up.
+        @param label: machine label.
+        """
+        super().release(label)
+        self._start_or_create_machines()
+
+    def _restore(self, label):
+        """Restore the machine's volume from its configured snapshot, by
+        replacing the attached volume with a fresh one created from it.
+
+        The volume replacement is driven through a shared asyncio loop when
+        aioboto3 is available, so concurrent restores overlap their EBS waits
+        instead of serializing one caller thread each; otherwise it runs
+        inline.
+        @param label: machine label.
+        @raise CuckooMachineError: if the restore fails.
+        """
+        log.info("Restoring machine %s", label)
+        machine = self._get_machine(label)
+        if not machine.snapshot:
+            raise CuckooMachineError(f"Restore failed for machine {label}: no snapshot configured")
+
+        state = self._status(label)
+        if state != AWS.POWEROFF:
+            raise CuckooMachineError(f"Instance {label} state {state} is not poweroff")
+
+        # Restore needs volume and placement data, so materialize a full
+        # Instance resource for its duration.
+        instance = self.ec2_resource.Instance(label)
+        volumes = list(instance.volumes.all())
+        if len(volumes) != 1:
+            raise CuckooMachineError(f"Instance {label} has {len(volumes)} volumes attached, expected exactly 1")
+        old_volume = volumes[0]
+        availability_zone = instance.placement["AvailabilityZone"]
+
+        if HAVE_AIOBOTO3:
+            future = asyncio.run_coroutine_threadsafe(
+                self._replace_volume_async(label, old_volume.id, machine.snapshot, availability_zone),
+                self._get_aio_loop(),
+            )
+            future.result()
+        else:
+            self._replace_volume(label, instance, old_volume, machine.snapshot, availability_zone)
+
+    def _replace_volume(self, label, instance, old_volume, snapshot_id, availability_zone):
+        """Blocking implementation of the volume replacement.
+        @param label: machine label.
+        @param instance: the Instance resource.
+        @param old_volume: the currently attached Volume resource.
+        @param snapshot_id: snapshot to create the new volume from.
+        @param availability_zone: availability zone of the instance.
+        @raise CuckooMachineError: if the replacement fails.
+        """
+        client = self.ec2_resource.meta.client
+
+        # The new volume only depends on the snapshot and the instance
+        # placement, so kick its creation off before detaching the old one;
+        # the two multi-second EBS operations then run server-side in
+        # parallel and a single waiter covers both.
+        log.debug("Creating new volume from snapshot %s", snapshot_id)
+        new_volume = self.ec2_resource.create_volume(
+            SnapshotId=snapshot_id,
+            AvailabilityZone=availability_zone,
+            VolumeType="gp2",
+        )
+
+        try:
+            log.debug("Detaching volume %s", old_volume.id)
+            instance.detach_volume(VolumeId=old_volume.id, Force=True)
+            self._invalidate_status(label)
+            client.get_waiter("volume_available").wait(
+                VolumeIds=[old_volume.id, new_volume.id], WaiterConfig=self.WAITER_CONFIG
+            )
+            old_volume.reload()
+            if old_volume.state != "available":
+                raise CuckooMachineError(f"Volume {old_volume.id} is in an unexpected state: {old_volume.state}")
+            new_volume.reload()
+            if new_volume.state != "available":
+                raise CuckooMachineError(f"Volume {new_volume.id} is in an unexpected state: {new_volume.state}")
+        except Exception:
+            # Don't leak the replacement volume if the detach side failed.
+            new_volume.delete()
+            raise
+
+        log.debug("Deleting old volume %s", old_volume.id)
+        old_volume.delete()
+
+        log.debug("Attaching new volume %s", new_volume.id)
+        instance.attach_volume(Device="/dev/sda1", VolumeId=new_volume.id)
+        self._invalidate_status(label)
+        client.get_waiter("volume_in_use").wait(VolumeIds=[new_volume.id], WaiterConfig=self.WAITER_CONFIG)
+        new_volume.reload()
+        if new_volume.state != "in-use":
+            raise CuckooMachineError(f"Volume {new_volume.id} is in an unexpected state: {new_volume.state}")
+
+    async def _replace_volume_async(self, label, old_volume_id, snapshot_id, availability_zone):
+        """Asyncio implementation of the volume replacement; any number of
+        machines can wait on their EBS transitions concurrently on the
+        shared loop.
+        @param label: machine label.
+        @param old_volume_id: id of the currently attached volume.
+        @param snapshot_id: snapshot to create the new volume from.
+        @param availability_zone: availability zone of the instance.
+        @raise CuckooMachineError: if the replacement fails.
+        """
+        async with self._aio_session.client("ec2") as client:
+            log.debug("Creating new volume from snapshot %s", snapshot_id)
+            response = await client.create_volume(
+                SnapshotId=snapshot_id, AvailabilityZone=availability_zone, VolumeType="gp2"
+            )
+            new_volume_id = response["VolumeId"]
+
+            try:
+                log.debug("Detaching volume %s", old_volume_id)
+                await client.detach_volume(VolumeId=old_volume_id, InstanceId=label, Force=True)
+                self._invalidate_status(label)
+                waiter = client.get_waiter("volume_available")
+                await waiter.wait(VolumeIds=[old_volume_id, new_volume_id], WaiterConfig=self.WAITER_CONFIG)
+            except Exception:
+                # Don't leak the replacement volume if the detach side failed.
+                await client.delete_volume(VolumeId=new_volume_id)
+                raise
+
+            log.debug("Deleting old volume %s", old_volume_id)
+            await client.delete_volume(VolumeId=old_volume_id)
+
+            log.debug("Attaching new volume %s", new_volume_id)
+            await client.attach_volume(Device="/dev/sda1", InstanceId=label, VolumeId=new_volume_id)
+            self._invalidate_status(label)
+            await client.get_waiter("volume_in_use").wait(VolumeIds=[new_volume_id], WaiterConfig=self.WAITER_CONFIG)
+
+    def _get_aio_loop(self):
+        """Lazily start the event loop thread that drives async restores.
+        @return: the running event loop.
+        """
+        with self._aio_loop_lock:
+            if self._aio_loop is None:
+                self._aio_loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._aio_loop.run_forever, name="aws-restore-loop", daemon=True)
+                thread.start()
+        return self._aio_loop
@@ -1,4 +1,6 @@
+import functools
 import os
+import pathlib
 
 import requests
 
@@ -8,27 +10,30 @@ CAPE_RAW_DOWNLOAD_TEMPLATE = os.environ.get(
     "https://raw.githubusercontent.com/kevoreilly/CAPEv2/refs/heads/master/data/yara/CAPE/{family}.yar",
 )
 
+# Rule locations, resolved once at import. This file lives at
+# <root>/modules/parsers/utils.py, so the CAPE(-like) root is two levels up.
+MACO_YARA_FOLDER = pathlib.Path(__file__).resolve().parent / "yara"
+CAPE_YARA_FOLDER = pathlib.Path(__file__).resolve().parents[2] / "data" / "yara" / "CAPE"
 
+
+# Cached so each family's rule is read from disk (or fetched) at most once
+# per process, no matter how often the extractor modules are (re)imported.
+@functools.cache
 def get_YARA_rule(family: str) -> str | None:
-    root = os.path.join(os.path.dirname(__file__))
-    maco_yara_folder = os.path.join(root, "yara")
     # Check to see if the rules local to MACO extractors exist (this can be rules cached from a previous run)
-    if not os.path.exists(os.path.join(root, "yara")):
-        os.makedirs(maco_yara_folder)
+    MACO_YARA_FOLDER.mkdir(exist_ok=True)
 
     # YARA rule paths that differ based on relativity to the MACO extractor
-    maco_yara_path = f"{maco_yara_folder}/{family}.yar"
-    cape_yara_path = os.path.join(os.path.dirname(__file__).split("/modules", 1)[0], f"data/yara/CAPE/{family}.yar")
+    maco_yara_path = MACO_YARA_FOLDER / f"{family}.yar"
+    cape_yara_path = CAPE_YARA_FOLDER / f"{family}.yar"
 
-    if os.path.exists(maco_yara_path):
+    if maco_yara_path.exists():
         # Return rule that seems to be directly related to MACO extractor
-        with open(maco_yara_path) as f:
-            return f.read()
+        return maco_yara_path.read_text()
     # Check to see if the rule exists in a CAPE or CAPE-like directory structure
-    elif os.path.exists(cape_yara_path):
+    elif cape_yara_path.exists():
         # Return the content of local YARA rule
-        with open(cape_yara_path) as f:
-            return f.read()
+        return cape_yara_path.read_text()
 
     try:
         # Local rule doesn't exist, but maybe we can retrieve the corresponding core rule from CAPEv2
@@ -36,8 +41,7 @@ def get_YARA_rule(family: str) -> str | None:
         resp = requests.get(CAPE_RAW_DOWNLOAD_TEMPLATE.format(family=family), timeout=10)
         if resp.ok:
             # Cache the rule on disk
-            with open(maco_yara_path, "w") as f:
-                f.write(resp.text)
+            maco_yara_path.write_text(resp.text)
             return resp.text
     except Exception as e:
         # No rule to be found, assume that extractor has proper exception handling or the rule is embedded